@@ -1,185 +1,104 @@
 from collections import defaultdict
+import os
 import random
+import signal
 import socket
+import struct
 import sys
+import traceback
 
-from dataclasses import dataclass
 from enum import Enum
-from typing import Tuple
+from typing import Optional, Tuple
 
 
-def _32bit_get(data: bytearray, offset: int) -> int:
-    return (data[offset] << 24) + (data[offset + 1] << 16) + (data[offset + 2] << 8) + data[offset + 3]
-
-
-def _32bit_set(data: bytearray, offset: int, value: int):
-    data[offset] = (value & 0xFF000000) >> 24
-    data[offset + 1] = (value & 0x00FF0000) >> 16
-    data[offset + 2] = (value & 0x0000FF00) >> 8
-    data[offset + 3] = (value & 0x000000FF)
+_U16 = struct.Struct('>H')
+_HDR = struct.Struct('>HHHHHH')
+_QTRAIL = struct.Struct('>HH')
+_ATRAIL = struct.Struct('>HHIH')
 
 
 def _16bit_get(data: bytearray, offset: int) -> int:
-    return (data[offset] << 8) + data[offset + 1]
-
-
-def _16bit_set(data: bytearray, offset: int, value: int):
-    data[offset] = (value & 0xFF00) >> 8
-    data[offset + 1] = value & 0x00FF
-
-
-def _bit_get(data: bytearray, offset: int, shift: int) -> int:
-    return (data[offset] & (0x01 << shift)) >> shift
-
-
-def _bit_set(data: bytearray, offset: int, shift: int, value: int):
-    data[offset] = data[offset] & ~(1 << shift)
-    if value:
-        data[offset] = data[offset] | (1 << shift)
-
-
-def _bits_get(data: bytearray, offset: int, mask: int, shift: int) -> int:
-    return (data[offset] & mask) >> shift
-
-
-def _bits_set(data: bytearray, offset: int, mask: int, shift: int, value: int):
-    data[offset] = data[offset] & ~mask
-    data[offset] = data[offset] | (value << shift)
-
-
-def _encode_labels(value) -> bytearray:
-    arr = bytearray()
-    for label in value.split('.'):
-        arr.append(len(label))
-        arr.extend(bytes(label, encoding='utf-8'))
-    arr.append(0x00)
-    return arr
+    return _U16.unpack_from(data, offset)[0]
+
+
+def _encode_labels(value) -> bytes:
+    parts = [p for p in value.encode('ascii').split(b'.') if p]
+    return b''.join(bytes((len(p),)) + p for p in parts) + b'\x00'
+
+
+def _read_labels(buf: bytearray, offset: int) -> Tuple[bytes, int]:
+    # Returns the name's labels with pointers resolved and the offset just
+    # past it, which for a compressed name is the byte after the first pointer.
+    # Each pointer has to jump before everything read so far, so a hostile
+    # packet cannot make us loop.
+    parts = []
+    end = None
+    limit = offset
+    while buf[offset] != 0x00:
+        if buf[offset] & 0b11000000 == 0b11000000:
+            if end is None:
+                end = offset + 2
+            target = _16bit_get(buf, offset) & 0x3FFF
+            if target >= limit:
+                raise ValueError(f"Label pointer at {offset} does not point backwards")
+            offset = limit = target
+            continue
+        n = buf[offset] + 1
+        parts.append(buf[offset:offset + n])
+        offset += n
+    if end is None:
+        end = offset + 1
+    parts.append(b'\x00')
+    return (b''.join(parts), end)
+
+
+def _decode_labels(labels: bytes) -> str:
+    parts = []
+    offset = 0
+    while labels[offset] != 0x00:
+        n = labels[offset]
+        offset += 1
+        parts.append(labels[offset:offset + n])
+        offset += n
+    return b'.'.join(parts).decode('ascii')
 
 
-def _decode_labels(bytes: bytearray, offset: int) -> Tuple[str, int]:
-    s = []
-    while bytes[offset] != 0x00: 
-        if bytes[offset] & 0b11000000 == 0b11000000:
-            offset = _16bit_get(bytes, offset) & 0x3FFF
-            continue 
-        n = int(bytes[offset])
-        offset += 1
-        s.append(bytes[offset: offset + n].decode("utf-8"))
-        offset += n 
-    return (".".join(s), offset)
+def _compress_labels(labels: bytes, offset: int, seen: dict[bytes, int]) -> bytes:
+    # Replaces the longest suffix of labels already written to the message
+    # with a pointer to it, and records the new suffixes written at offset.
+    i = 0
+    while labels[i] != 0x00:
+        suffix = labels[i:]
+        if suffix in seen:
+            return labels[:i] + _U16.pack(0xC000 | seen[suffix])
+        if offset + i <= 0x3FFF:
+            seen[suffix] = offset + i
+        i += labels[i] + 1
+    return labels
 
 
 class DNSHeader:
-    def __init__(self, payload: bytearray):
-        assert(len(payload) == 12)
-        self._payload = payload
+    __slots__ = ('id', 'qr', 'opcode', 'aa', 'tc', 'rd', 'ra', 'z', 'rcode',
+                 'qdcount', 'ancount', 'nscount', 'arcount')
+
+    def __init__(self, payload: bytearray, offset: int = 0):
+        (self.id, flags,
+         self.qdcount, self.ancount, self.nscount, self.arcount) = _HDR.unpack_from(payload, offset)
+        self.qr = (flags >> 15) & 0b1
+        self.opcode = (flags >> 11) & 0b1111
+        self.aa = (flags >> 10) & 0b1
+        self.tc = (flags >> 9) & 0b1
+        self.rd = (flags >> 8) & 0b1
+        self.ra = (flags >> 7) & 0b1
+        self.z = (flags >> 4) & 0b111
+        self.rcode = flags & 0b1111
 
     def payload(self) -> bytes:
-        return bytes(self._payload)
-
-    @property 
-    def id(self) -> int:
-        return _16bit_get(self._payload, 0)
-    
-    @id.setter
-    def id(self, value: int):
-        return _16bit_set(self._payload, 0, value)
-
-    @property 
-    def qr(self) -> int:
-        return _bit_get(self._payload, 2, 7)
-    
-    @qr.setter
-    def qr(self, value: int):
-        _bit_set(self._payload, 2, 7, value)
-
-    @property 
-    def opcode(self) -> int:
-        return _bits_get(self._payload, 2, 0b01111000, 3)
-    
-    @opcode.setter
-    def opcode(self, value: int):
-        _bits_set(self._payload, 2, 0b01111000, 3, value & 0b00001111)
-
-    @property 
-    def aa(self) -> int:
-        return _bits_get(self._payload, 2, 0b00000100, 2)
-    
-    @aa.setter
-    def aa(self, value: int):
-        _bits_set(self._payload, 2, 0b00000100, 2, value & 0b00000001)
-
-    @property 
-    def tc(self) -> int:
-        return _bits_get(self._payload, 2, 0b00000010, 1)
-    
-    @tc.setter
-    def tc(self, value: int):
-        _bits_set(self._payload, 2, 0b00000010, 1, value & 0b00000001)
-
-    @property 
-    def rd(self) -> int:
-        return _bits_get(self._payload, 2, 0b00000001, 0)
-    
-    @rd.setter
-    def rd(self, value: int):
-        _bits_set(self._payload, 2, 0b00000001, 0, value & 0b00000001)
-
-    @property 
-    def ra(self) -> int:
-        return _bits_get(self._payload, 3, 0b10000000, 7)
-    
-    @ra.setter
-    def ra(self, value: int):
-        _bits_set(self._payload, 3, 0b10000000, 7, value & 0b00000001)
-
-    @property 
-    def z(self) -> int:
-        return _bits_get(self._payload, 3, 0b01110000, 4)
-    
-    @z.setter
-    def z(self, value: int):
-        _bits_set(self._payload, 3, 0b01110000, 4, value & 0b00000111)
-    
-    @property 
-    def rcode(self) -> int:
-        return _bits_get(self._payload, 3, 0b00001111, 0)
-    
-    @rcode.setter
-    def rcode(self, value: int):
-        _bits_set(self._payload, 3, 0b00001111, 0, value & 0b00001111)
-
-    @property 
-    def qdcount(self) -> int:
-        return _16bit_get(self._payload, 4)
-    
-    @qdcount.setter
-    def qdcount(self, value: int):
-        _16bit_set(self._payload, 4, value)
-
-    @property 
-    def ancount(self) -> int:
-        return _16bit_get(self._payload, 6)
-    
-    @ancount.setter
-    def ancount(self, value: int):
-        _16bit_set(self._payload, 6, value)
-
-    @property 
-    def nscount(self) -> int:
-        return _16bit_get(self._payload, 8)
-    
-    @nscount.setter
-    def nscount(self, value: int):
-        _16bit_set(self._payload, 8, value)
-
-    @property 
-    def arcount(self) -> int:
-        return _16bit_get(self._payload, 10)
-    
-    @arcount.setter
-    def arcount(self, value: int):
-        _16bit_set(self._payload, 10, value)
+        flags = (((self.qr & 0b1) << 15) | ((self.opcode & 0b1111) << 11)
+                 | ((self.aa & 0b1) << 10) | ((self.tc & 0b1) << 9) | ((self.rd & 0b1) << 8)
+                 | ((self.ra & 0b1) << 7) | ((self.z & 0b111) << 4) | (self.rcode & 0b1111))
+        return _HDR.pack(self.id, flags,
+                         self.qdcount, self.ancount, self.nscount, self.arcount)
 
     def __repr__(self) -> str:
         return f"Header({self.id=}, {self.qr=}, {self.opcode=}, {self.aa=}, {self.tc=}, {self.rd=}, {self.ra=}, {self.z=}, {self.rcode=}, {self.qdcount=}, {self.ancount=}, {self.nscount=}, {self.arcount=})"
@@ -217,109 +136,106 @@ class DNSRRClass(Enum):
     HS = 4 # Hesiod [Dyer 87]
 
 
+_RRTYPE = DNSRRType._value2member_map_
+_RRCLASS = DNSRRClass._value2member_map_
+
+
 class DNSQuestion:
-    def __init__(self, payload: bytearray):
-        self._payload = payload 
+    __slots__ = ('_labels', '_typ', '_cls')
 
-    def payload(self) -> bytearray:
-        return bytearray(self._payload)
+    def __init__(self, payload: bytearray, offset: int = 0, labels: bytes = b''):
+        self._labels = labels
+        self._typ, self._cls = _QTRAIL.unpack_from(payload, offset)
+
+    def payload(self) -> bytes:
+        return self._labels + self.trailer()
+
+    def trailer(self) -> bytes:
+        return _QTRAIL.pack(self._typ, self._cls)
+
+    def labels(self) -> bytes:
+        return self._labels
     
     @property
     def domain_name(self) -> str:
-        return _decode_labels(self._payload, 0)[0]
+        return _decode_labels(self._labels)
     
     @domain_name.setter
     def domain_name(self, value: str) -> str:
-        self._payload[:-4] = _encode_labels(value)
+        self._labels = _encode_labels(value)
     
     @property
     def typ(self) -> DNSRRType:
-        return DNSRRType(_16bit_get(self._payload, len(self._payload) - 4))
+        return _RRTYPE[self._typ]
     
     @typ.setter
     def typ(self, ty: DNSRRType):
-        _16bit_set(self._payload, len(self._payload) - 4, ty.value)
+        self._typ = ty.value
 
     @property
     def cls(self) -> DNSRRClass:
-        return DNSRRClass(_16bit_get(self._payload, len(self._payload) - 2))
+        return _RRCLASS[self._cls]
     
     @cls.setter
     def cls(self, cls: DNSRRClass):
-        _16bit_set(self._payload, len(self._payload) - 2, cls.value)
+        self._cls = cls.value
 
     def __repr__(self) -> str:
         return f"Question({self.domain_name=}, {self.typ=}, {self.cls=})"
 
 
 class DNSAnswer:
-    def __init__(self, payload: bytearray):
-        self._payload = payload 
-        self._label_len = 0
+    __slots__ = ('_labels', '_typ', '_cls', 'ttl', 'data')
+
+    def __init__(self, payload: bytearray, offset: int = 0, labels: bytes = b''):
+        self._labels = labels
+        self._typ, self._cls, self.ttl, length = _ATRAIL.unpack_from(payload, offset)
+        offset += _ATRAIL.size
+        self.data = bytes(payload[offset:offset + length])
 
-    def payload(self) -> bytearray:
-        return bytearray(self._payload)
+    def payload(self) -> bytes:
+        return self._labels + self.trailer()
+
+    def trailer(self) -> bytes:
+        return _ATRAIL.pack(self._typ, self._cls, self.ttl, len(self.data)) + self.data
 
-    def labels(self) -> bytearray:
-        return self._payload[:-4]
+    def labels(self) -> bytes:
+        return self._labels
     
     @property
     def name(self) -> str:
-        return _decode_labels(self._payload, 0)[0]
+        return _decode_labels(self._labels)
     
     @name.setter
     def name(self, value: str):
-        bytes = _encode_labels(value)
-        self._payload[:self._label_len] = bytes
-        self._label_len = len(bytes)
+        self._labels = _encode_labels(value)
     
     @property
     def typ(self) -> DNSRRType:
-        return DNSRRType(_16bit_get(self._payload, self._label_len))
+        return _RRTYPE[self._typ]
     
     @typ.setter
     def typ(self, ty: DNSRRType):
-        _16bit_set(self._payload, self._label_len, ty.value)
+        self._typ = ty.value
 
     @property
     def cls(self) -> DNSRRClass:
-        return DNSRRClass(_16bit_get(self._payload, self._label_len + 2))
+        return _RRCLASS[self._cls]
     
     @cls.setter
     def cls(self, cls: DNSRRClass):
-        _16bit_set(self._payload, self._label_len + 2, cls.value)
-
-    @property
-    def ttl(self) -> int:
-        return _32bit_get(self._payload, self._label_len + 4)
-    
-    @ttl.setter
-    def ttl(self, value: int):
-        _32bit_set(self._payload, self._label_len + 4, value)
+        self._cls = cls.value
 
     @property
     def length(self) -> int:
-        return _16bit_get(self._payload, self._label_len + 8)
-    
-    @length.setter
-    def length(self, value: int):
-        _16bit_set(self._payload, self._label_len + 8, value)
-
-    @property
-    def data(self) -> bytearray:
-        return self._payload[self._label_len + 10:]
-    
-    @data.setter
-    def data(self, value: bytearray):
-        self.length = len(value)
-        self._payload[self._label_len + 10:] = value
+        return len(self.data)
 
     def __repr__(self) -> str:
         return f"Question({self.name=}, {self.typ=}, {self.cls=}, {self.ttl=}, {self.length=}, {self.data=})"
 
 
-@dataclass
 class DNSMessage:
+    __slots__ = ('header', 'questions', 'answers')
 
     def __init__(self, header: DNSHeader, questions: list[DNSQuestion], answers: list[DNSAnswer]):
         self.header = header
@@ -329,36 +245,36 @@ class DNSMessage:
         self.header.ancount = len(answers)
 
     def payload(self) -> bytes:
-        bytes = bytearray()
-        bytes.extend(self.header.payload())
-        [bytes.extend(q.payload()) for q in self.questions]
-        [bytes.extend(a.payload()) for a in self.answers]
-        return bytes
+        parts = [self.header.payload()]
+        offset = _HDR.size
+        seen = {}
+        for record in (*self.questions, *self.answers):
+            labels = _compress_labels(record.labels(), offset, seen)
+            trailer = record.trailer()
+            parts += (labels, trailer)
+            offset += len(labels) + len(trailer)
+        return b''.join(parts)
         
     @staticmethod 
     def from_bytes(payload: bytes):
+        if len(payload) < _HDR.size:
+            raise ValueError(f"DNS message too short: {len(payload)} bytes")
         offset = 0
-        header = DNSHeader(bytearray(payload[offset:offset + 12]))
+        header = DNSHeader(payload, offset)
         offset += 12
         
         questions = []
         for _ in range(header.qdcount):
-            domain_name, offset = _decode_labels(payload, offset)
-            offset += 1
-            question = DNSQuestion(bytearray(payload[offset: offset + 4]))
-            offset += 4
-            question.domain_name = domain_name
+            labels, offset = _read_labels(payload, offset)
+            question = DNSQuestion(payload, offset, labels)
+            offset += _QTRAIL.size
             questions.append(question)
 
         answers = []
         for _ in range(header.ancount):
-            name, offset = _decode_labels(payload, offset)
-            offset += 1
-            answer = DNSAnswer(bytearray(payload[offset: offset + 10]))
-            offset += 10
-            answer.name = name
-            len = payload[offset - 1]
-            answer.data = bytearray(payload[offset: offset + len])
+            labels, offset = _read_labels(payload, offset)
+            answer = DNSAnswer(payload, offset, labels)
+            offset += _ATRAIL.size + answer.length
             answers.append(answer)
 
         return DNSMessage(header, questions, answers) 
@@ -367,22 +283,58 @@ class DNSMessage:
         return f"Message({self.header=}, {self.questions=}, {self.answers=})"
 
 
-def main():
+# Raised by from_bytes for truncated or malformed datagrams.
+_PARSE_ERRORS = (ValueError, struct.error, IndexError)
 
+_FIXED_ANSWER = _ATRAIL.pack(DNSRRType.A.value, DNSRRClass.IN.value, 60, 4) + bytes((8, 8, 8, 8))
+
+
+def build_response(header: DNSHeader, questions: list[DNSQuestion]) -> bytes:
+    # Without an upstream resolver every question gets the same A/IN answer,
+    # so the reply is pasted together from precomputed pieces instead of
+    # going through DNSMessage. Answer names point back at their question.
+    rcode = 0 if header.opcode == 0 else 4
+    flags = 0x8000 | ((header.opcode & 0b1111) << 11) | ((header.rd & 0b1) << 8) | rcode
+    parts = [_HDR.pack(header.id, flags, len(questions), len(questions), 0, 0)]
+    offset = _HDR.size
+    pointers = []
+    for q in questions:
+        pointers.append(_U16.pack(0xC000 | offset))
+        question = q.payload()
+        parts.append(question)
+        offset += len(question)
+    parts += [pointer + _FIXED_ANSWER for pointer in pointers]
+    return b''.join(parts)
+
+
+def serve(resolver: Optional[Tuple[str, int]], workers: int):
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if workers > 1:
+        # Every worker binds its own socket and the kernel spreads datagrams
+        # across them. A single server keeps the plain bind so a second
+        # instance fails with EADDRINUSE instead of stealing traffic.
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     udp_socket.bind(("127.0.0.1", 2053))
     udp_resolver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    
-    if '--resolver' in sys.argv:
-        ip, port = sys.argv[-1].split(":")
-        resolver = (ip, int(port))
-    else:
-        resolver = None
+    if resolver is not None:
+        udp_resolver.connect(resolver)
+
+    buf = bytearray(512)
+    view = memoryview(buf)
+    res_buf = bytearray(512)
+    res_view = memoryview(res_buf)
 
     while True:
         try:
-            buf, source = udp_socket.recvfrom(512)
-            received = DNSMessage.from_bytes(buf)
+            nbytes, source = udp_socket.recvfrom_into(buf, 512)
+            try:
+                received = DNSMessage.from_bytes(view[:nbytes])
+            except _PARSE_ERRORS as e:
+                print(f"Dropping malformed query from {source}: {e}")
+                continue
+            if resolver is None:
+                udp_socket.sendto(build_response(received.header, received.questions), source)
+                continue
 
             ans = []
             header_id = received.header.id
@@ -390,9 +342,19 @@ def main():
             for q in received.questions:
                 received.header.id = random.randrange(0, 0xFFFF)
                 message = DNSMessage(received.header, [q], [])
-                udp_resolver.sendto(message.payload(), resolver)
-                res_buf, _ = udp_resolver.recvfrom(512)
-                resolved = DNSMessage.from_bytes(res_buf)
+                try:
+                    udp_resolver.send(message.payload())
+                    nbytes = udp_resolver.recv_into(res_buf, 512)
+                except OSError as e:
+                    # The connected socket reports ICMP errors from the
+                    # resolver here; skip the question, not the server.
+                    print(f"Resolver {resolver} failed: {e}")
+                    continue
+                try:
+                    resolved = DNSMessage.from_bytes(res_view[:nbytes])
+                except _PARSE_ERRORS as e:
+                    print(f"Dropping malformed reply from {resolver}: {e}")
+                    continue
                 ans.extend(resolved.answers)
     
             received.header.id = header_id
@@ -408,5 +370,57 @@ def main():
             break
 
 
+def main():
+    if '--resolver' in sys.argv:
+        ip, port = sys.argv[sys.argv.index('--resolver') + 1].split(":")
+        resolver = (ip, int(port))
+    else:
+        resolver = None
+
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    else:
+        workers = 1
+
+    children = []
+    for _ in range(workers - 1):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                serve(resolver, workers)
+            except KeyboardInterrupt:
+                status = 130
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        children.append(pid)
+
+    def _terminate(signum, frame):
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, _terminate)
+    signal.signal(signal.SIGINT, _terminate)
+    try:
+        serve(resolver, workers)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
 if __name__ == "__main__":
     main()